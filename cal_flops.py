@@ -2,9 +2,11 @@ import numpy as np
 import torch
 from fvcore.nn import FlopCountAnalysis
 from fvcore.nn import flop_count_table
+from fvcore.nn.jit_handles import elementwise_flop_counter
 
 from timm.models import create_model
 from uninet import *
+from utils import sdpa_flop_jit
 
 input_size = 224
 
@@ -12,4 +14,6 @@ model = create_model('UniNetB1')
 model.eval()
 
 flops = FlopCountAnalysis(model, torch.rand(1, 3, input_size, input_size))
+flops.set_op_handle('aten::scaled_dot_product_attention', sdpa_flop_jit)
+flops.set_op_handle('aten::mean', elementwise_flop_counter(1, 0))  # global pools, as adaptive_avg_pool2d
 print(flop_count_table(flops, max_depth=2))
@@ -27,6 +27,7 @@ from timm.utils import NativeScaler, get_state_dict, ModelEma, ApexScaler
 import timm.models
 from fvcore.nn import FlopCountAnalysis
 from fvcore.nn import flop_count_table
+from fvcore.nn.jit_handles import elementwise_flop_counter
 
 from datasets import build_dataset
 from engine import train_one_epoch, evaluate
@@ -173,6 +174,8 @@ def get_args_parser():
     parser.add_argument('--eval', action='store_true', help='Perform evaluation only')
     parser.add_argument('--dist-eval', action='store_true', default=False, help='Enabling distributed evaluation')
     parser.add_argument('--num_workers', default=8, type=int)
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='torch.compile the model with static shapes (torch>=2.0)')
     parser.add_argument('--pin-mem', action='store_true',
                         help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
     parser.add_argument('--no-pin-mem', action='store_false', dest='pin_mem',
@@ -209,7 +212,11 @@ def main(args):
     np.random.seed(seed)
     random.seed(seed)
 
+    # lets cuDNN pick its NHWC depthwise kernels for the channels_last model
     cudnn.benchmark = True
+    if args.eval:
+        # TF32 attention / linear GEMMs on Ampere+ (convs already default to TF32 in cuDNN)
+        torch.backends.cuda.matmul.allow_tf32 = True
 
     dataset_train, args.nb_classes = build_dataset(is_train=True, args=args)
     dataset_val, _ = build_dataset(is_train=False, args=args)
@@ -295,6 +302,8 @@ def main(args):
     if utils.get_rank() == 0:
         model.eval()
         flops = FlopCountAnalysis(model, torch.rand(1, 3, args.input_size, args.input_size).to(device))
+        flops.set_op_handle('aten::scaled_dot_product_attention', utils.sdpa_flop_jit)
+        flops.set_op_handle('aten::mean', elementwise_flop_counter(1, 0))  # global pools, as adaptive_avg_pool2d
         if args.rank == 0:
             print(flop_count_table(flops))
         model.train()
@@ -329,6 +338,11 @@ def main(args):
         amp_autocast = torch.cuda.amp.autocast
         loss_scaler = NativeScaler()
         model = NativeDDP(model, device_ids=[args.gpu], find_unused_parameters=False)
+    if args.compile:
+        # after the FLOP table (jit trace) and EMA deepcopy, which both need the eager model;
+        # every factory fixes input_size, so the graph is shape-static and can be specialized
+        assert hasattr(torch, 'compile'), '--compile requires torch>=2.0'
+        model = torch.compile(model, dynamic=False)
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print(f'number of params: {n_parameters}')
 
@@ -1,4 +1,6 @@
 import math
+from typing import Tuple
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -12,20 +14,52 @@ def _make_divisible(v, divisor, min_value=None):
         new_v += divisor
     return new_v
 
-def to4d(x):
-    if len(x.shape) == 4:
+def to4d(x, h: int = -1):
+    # pass the spatial side h when it is known to skip the square root
+    if x.dim() == 4:
         return x
     B, N, C = x.shape
-    h = int(N ** 0.5)
-    return x.transpose(1, 2).reshape(B, C, h, h)
+    if h < 0:
+        h = int(N ** 0.5)
+    # (B, N, C) tokens are a channels_last (B, C, h, h) map, so this is a view
+    return x.reshape(B, h, h, C).permute(0, 3, 1, 2)
 
 
 def to3d(x):
-    if len(x.shape) == 3:
+    if x.dim() == 3:
         return x
     B, C, h, w = x.shape
     N = h * w
-    return x.reshape(B, C, N).transpose(1, 2)
+    # a view for channels_last inputs
+    return x.permute(0, 2, 3, 1).reshape(B, N, C)
+
+
+@torch.no_grad()
+def fuse_conv_bn(conv, bn):
+    # fold an eval-mode BatchNorm2d into the preceding conv: w' = w * g / std, b' = (b - mean) * g / std + beta
+    scale = bn.weight / (bn.running_var + bn.eps).sqrt()
+    conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+    return conv
+
+
+@torch.jit.script
+def add_ln(x, r, weight, bias, eps: float) -> Tuple[torch.Tensor, torch.Tensor]:
+    # residual add + LayerNorm in one pass; returns the sum and its normalized copy
+    x = x + r
+    return x, F.layer_norm(x, [x.shape[-1]], weight, bias, eps)
+
+
+@torch.jit.script
+def hard_sigmoid(x, inplace: bool = False):
+    return F.relu6(x + 3, inplace) / 6
+
+
+@torch.jit.script
+def _se_apply(s, x):
+    # hard_sigmoid + broadcast multiply, fused into a single pointwise kernel
+    return x * hard_sigmoid(s)
 
 
 class SqueezeExcitation(nn.Module):
@@ -37,19 +71,11 @@ class SqueezeExcitation(nn.Module):
         self.relu = nn.ReLU(inplace=True)
         self.fc2 = nn.Conv2d(squeeze_channels, input_channels, 1)
 
-    def _scale(self, input, inplace):
-        scale = F.adaptive_avg_pool2d(input, 1)
+    def _scale(self, input):
+        scale = input.mean(dim=(2, 3), keepdim=True)
         scale = self.fc1(scale)
         scale = self.relu(scale)
-        scale = self.fc2(scale)
-        # return F.hardsigmoid(scale, inplace=inplace)
-        return hard_sigmoid(scale, inplace=inplace)
+        return self.fc2(scale)
 
     def forward(self, input):
-        scale = self._scale(input, True)
-        return scale * input
-
-
-def hard_sigmoid(x, inplace=False):
-    return F.relu6(x + 3, inplace) / 6
-
+        return _se_apply(self._scale(input), input)
@@ -13,21 +13,27 @@ import torch.utils.checkpoint as checkpoint
 
 from timm.models.layers import PatchEmbed, Mlp, DropPath, trunc_normal_, lecun_normal_
 from timm.models.registry import register_model
-from model_utils import _make_divisible, SqueezeExcitation, to3d, to4d
+from model_utils import _make_divisible, SqueezeExcitation, to3d, to4d, fuse_conv_bn, add_ln
+
+# fused attention (flash / memory-efficient kernels) with an explicit scale needs torch>=2.1
+has_sdpa = tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1)
 
 
 class LocalDSM(nn.Module):
+    expected_rank = 4
+
     def __init__(self, in_features, out_features, stride=1, mlp_ratio=4, head_dim=32,
-                 qkv_bias=True, qk_scale=None, drop=0., drop_path=0., attn_drop=0., seq_l=196):
+                 qkv_bias=True, qk_scale=None, drop=0., drop_path=0., attn_drop=0., seq_l=196,
+                 strided_residual=False):
         super().__init__()
         h = w = int(seq_l ** 0.5)
         new_h = new_w = math.ceil(h / stride)
         self.h = h
         self.new_h = new_h
         self.new_N = self.new_h * self.new_h
-        if stride == 1:
+        if stride == 1 or strided_residual:
             self.residual = nn.Sequential(
-                nn.Conv2d(in_features, out_features, kernel_size=1)
+                nn.Conv2d(in_features, out_features, kernel_size=1, stride=stride)
             )
         else:
             self.residual = nn.Sequential(
@@ -42,15 +48,16 @@ class LocalDSM(nn.Module):
         )
         
     def forward(self, x):
-        x_shape = x.shape
-        if len(x_shape) == 3:
-            x = to4d(x)
+        x = to4d(x, self.h)
         return self.downsample(x) + self.residual(x)
 
 
 class LocalGlobalDSM(nn.Module):
+    expected_rank = 3
+
     def __init__(self, in_features, out_features, stride=1, mlp_ratio=4, head_dim=32,
-                 qkv_bias=True, qk_scale=None, drop=0., drop_path=0., attn_drop=0., seq_l=196):
+                 qkv_bias=True, qk_scale=None, drop=0., drop_path=0., attn_drop=0., seq_l=196,
+                 strided_residual=False):
         super().__init__()
         out_dim = out_features or in_features
         self.num_heads = out_features // head_dim
@@ -64,9 +71,9 @@ class LocalGlobalDSM(nn.Module):
         self.new_h = new_h
         self.new_N = self.new_h * self.new_h
 
-        if stride == 1:
+        if stride == 1 or strided_residual:
             self.residual = nn.Sequential(
-                nn.Conv2d(in_features, out_features, kernel_size=1)
+                nn.Conv2d(in_features, out_features, kernel_size=1, stride=stride)
             )
         else:
             self.residual = nn.Sequential(
@@ -87,25 +94,22 @@ class LocalGlobalDSM(nn.Module):
         self.proj = nn.Linear(out_features, out_features)
 
     def forward(self, x):
-        x_shape = x.shape
-        if len(x.shape) == 3:
-            B, N, C = x_shape
-        else:
-            B, C, H, W = x_shape
-            N = H * W
-        
-        x = to4d(x)
-        residual = to3d(self.residual(x))
-        q = to3d(self.q(x))
+        # the caller hands us tokens (B, N, C); the conv paths read a 4d view of them
         x = to3d(x)
+        B, N, C = x.shape
+
+        x4d = to4d(x, self.h)
+        residual = to3d(self.residual(x4d))
+        q = to3d(self.q(x4d))
 
         q = self.q_norm(q)
         x = self.kv_norm(x)
-        q = q.reshape(B, self.new_N, self.num_heads, self.head_dim).permute(0, 2, 1, 3)
-        kv = self.kv(x).reshape(B, N, 2, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
-        k, v = kv[0], kv[1]   # make torchscript happy (cannot use tensor as tuple)
+        q = q.view(B, self.new_N, self.num_heads, self.head_dim).transpose(1, 2)
+        # split k/v on the fused (B, N, 2, H, D) view; only the (N, H) axes are swapped
+        k, v = self.kv(x).view(B, N, 2, self.num_heads, self.head_dim).unbind(2)
+        k, v = k.transpose(1, 2), v.transpose(1, 2)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
+        attn = (q * self.scale) @ k.transpose(-2, -1)
         attn = attn.softmax(dim=-1)
 
         x = (attn @ v).transpose(1, 2).reshape(B, self.new_N, self.out_features)
@@ -115,10 +119,14 @@ class LocalGlobalDSM(nn.Module):
 
 
 class DWConvBlock(nn.Module):
+    expected_rank = 4
+    takes_drop_mask = True
+
     def __init__(self, in_features, out_features=None, stride=1,
                  mlp_ratio=4, use_se=True, drop=0., drop_path=0.,
                  seq_l=196, head_dim=32, init_values=1e-6, **kwargs):
         super().__init__()
+        self.h = int(seq_l ** 0.5)
         out_features = out_features or in_features
         hidden_features = int(in_features * mlp_ratio)
         if in_features != out_features or stride != 1:
@@ -154,12 +162,14 @@ class DWConvBlock(nn.Module):
         if init_values != -1:
             zeros_(self.b2[-1].weight)
 
-    def forward(self, x):
+    def forward(self, x, drop_mask=None):
         residual = self.residual(x)
         if self.b1 is not None:
             x = self.b1(x)
         x = self.b2(x)
 
+        if drop_mask is not None:
+            return torch.addcmul(residual, drop_mask[:, None, None, None].to(x.dtype), x)
         return residual + self.drop_path(x)
 
 
@@ -170,10 +180,11 @@ class Attention(nn.Module):
         out_dim = out_dim or dim
         self.num_heads = num_heads
         head_dim = dim // num_heads
+        self.head_dim = head_dim
         self.scale = qk_scale or head_dim ** -0.5
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
-        self.attn_drop = nn.Dropout(attn_drop)
+        self.drop_prob = attn_drop
         self.proj = nn.Linear(dim, out_dim)
         self.proj_drop = nn.Dropout(proj_drop)
         self.custom_flops = 2 * seq_l * seq_l * dim
@@ -181,25 +192,36 @@ class Attention(nn.Module):
 
     def forward(self, x, head=0, mask_type=None):
         B, N, C = x.shape
-        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-        if self.fp32_attn:
-            q, k, v = qkv[0].float(), qkv[1].float(), qkv[2].float()
-        else:
-            q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
-
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        # the Linear output is contiguous, so the split is a view; only (N, H) are swapped per tensor
+        q, k, v = self.qkv(x).view(B, N, 3, self.num_heads, self.head_dim).unbind(2)
+        q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+        drop_prob = self.drop_prob if self.training else 0.
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
         if self.fp32_attn:
+            with torch.autocast(device_type=x.device.type, enabled=False):
+                x = self._attend(q.float(), k.float(), v.float(), drop_prob)
             x = x.to(self.proj.weight.dtype)
+        else:
+            x = self._attend(q, k, v, drop_prob)
+
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
 
+    def _attend(self, q, k, v, drop_prob: float):
+        if has_sdpa:
+            # never materializes the (B, H, N, N) score matrix
+            return F.scaled_dot_product_attention(q, k, v, dropout_p=drop_prob, scale=self.scale)
+        attn = (q * self.scale) @ k.transpose(-2, -1)
+        attn = attn.softmax(dim=-1)
+        attn = F.dropout(attn, p=drop_prob)
+        return attn @ v
+
 
 class AttentionBlock(nn.Module):
+    expected_rank = 3
+    takes_drop_mask = True
 
     def __init__(self, in_features, out_features, stride=1, mlp_ratio=4, head_dim=32,
                  qkv_bias=True, qk_scale=None, drop=0., drop_path=0., attn_drop=0., seq_l=196,
@@ -207,6 +229,7 @@ class AttentionBlock(nn.Module):
         super().__init__()
         self.norm1 = nn.LayerNorm(in_features)
         self.stride = stride
+        self.h = int(seq_l ** 0.5)
         self.in_features = in_features
         self.out_features = out_features
         mlp_hidden_dim = int(in_features * mlp_ratio)
@@ -233,35 +256,57 @@ class AttentionBlock(nn.Module):
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
 
 
-    def forward(self, x, head=0, mask_type=None):
-        x = x + to3d(self.pos_embed(to4d(x)))
+    def forward(self, x, head=0, mask_type=None, drop_mask=None):
+        # x + pos_embed(x) and norm1 of the sum in a single fused pass
+        x, y = add_ln(x, to3d(self.pos_embed(to4d(x, self.h))), self.norm1.weight, self.norm1.bias, self.norm1.eps)
         if self.stride == 1 and self.in_features == self.out_features:
-            if self.init_values != -1:
-                x = x + self.drop_path(self.gamma_1 * self.attn(self.norm1(x), head=head, mask_type=mask_type))
-                x = x + self.drop_path(self.gamma_2 * self.mlp(self.norm2(x)))
-            else:
-                x = x + self.drop_path(self.attn(self.norm1(x), head=head, mask_type=mask_type))
-                x = x + self.drop_path(self.mlp(self.norm2(x)))
+            gamma_1 = self.gamma_1 if self.init_values != -1 else None
+            gamma_2 = self.gamma_2 if self.init_values != -1 else None
+            # attention residual add fused with norm2 of the sum
+            x, y = add_ln(x, self._branch(self.attn(y, head=head, mask_type=mask_type), gamma_1, drop_mask),
+                          self.norm2.weight, self.norm2.bias, self.norm2.eps)
+            x = self._residual(x, self.mlp(y), gamma_2, drop_mask)
         else:
-            residual = to3d(self.residual(to4d(x)))
-            x = self.norm1(x)
-            x = to3d(self.ds(to4d(x)))
+            residual = to3d(self.residual(to4d(x, self.h)))
+            x = to3d(self.ds(to4d(y, self.h)))
             x = self.attn(x)
             if self.init_values != -1:
-                x = residual + self.gamma_1 * x
+                x = torch.addcmul(residual, self.gamma_1, x)
             else:
                 x = residual + x
         return x
 
+    def _branch(self, y, gamma=None, drop_mask=None):
+        # drop_path(gamma * y); layer scale and a precomputed keep mask fold into one multiply
+        if drop_mask is not None:
+            scale = drop_mask[:, None, None].to(y.dtype)
+            return y * (scale if gamma is None else gamma * scale)
+        return self.drop_path(y if gamma is None else gamma * y)
+
+    def _residual(self, x, y, gamma=None, drop_mask=None):
+        # x + drop_path(gamma * y); layer scale and a precomputed keep mask fold into one addcmul
+        if drop_mask is not None:
+            scale = drop_mask[:, None, None].to(y.dtype)
+            return torch.addcmul(x, scale if gamma is None else gamma * scale, y)
+        if gamma is None:
+            return x + self.drop_path(y)
+        if self.training and not isinstance(self.drop_path, nn.Identity):
+            return x + self.drop_path(gamma * y)
+        return torch.addcmul(x, gamma, y)
+
 
 class VisionTransformer(nn.Module):
     def __init__(self, repeats, expansion, channels, strides=[1, 2, 2, 2, 1, 2], num_classes=1000, drop_path_rate=0.,
                  input_size=224, weight_init='', head_dim=32, final_head_dim=1280, final_drop=0.0, init_values=1e-6, 
                  block_ops=[DWConvBlock] * 3 + [AttentionBlock] * 3, checkpoint=0, stem_dim=32, 
-                 ds_ops=[LocalDSM] * 3 + [LocalGlobalDSM] * 2, **kwargs):
+                 ds_ops=[LocalDSM] * 3 + [LocalGlobalDSM] * 2, strided_residual=False, **kwargs):
+        # strided_residual: downsampling shortcuts use a single strided 1x1 conv instead of
+        # maxpool -> 1x1 conv (one kernel and one read of x less; not compatible with the
+        # released checkpoints). Only forwarded to ds_ops when set.
         super().__init__()
         self.num_classes = num_classes
         self.checkpoint = checkpoint
+        self.drop_path_rate = drop_path_rate
 
         # stem_dim = 32
         h = w = input_size
@@ -271,8 +316,11 @@ class VisionTransformer(nn.Module):
             nn.GELU(),
         )
 
-        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, sum(repeats))]  # stochastic depth decay rule
-        dpr.reverse()
+        dp_probs = torch.linspace(0, drop_path_rate, sum(repeats))  # stochastic depth decay rule
+        dpr = dp_probs.tolist()
+        # per-block keep masks are sampled for all blocks at once in forward_features
+        self.register_buffer('dp_probs', dp_probs, persistent=False)
+        drop_path_idx = {}
 
         cin = stem_dim
         blocks = []
@@ -284,7 +332,9 @@ class VisionTransformer(nn.Module):
             # print(f'stage {stage}, cin {cin}, cout {cout}, s {strides[stage]}, e {expansion[stage]} b {block_op}')
 
             if stage != 0:
-                blocks.append(ds_ops[stage - 1](cin, cout, stride=strides[stage], seq_l=seq_l, head_dim=head_dim))
+                ds_kwargs = dict(strided_residual=True) if strided_residual else {}
+                blocks.append(ds_ops[stage - 1](cin, cout, stride=strides[stage], seq_l=seq_l, head_dim=head_dim,
+                                                **ds_kwargs))
                 h = w = math.ceil(h / strides[stage])
                 seq_l = h * w
                 cin = cout
@@ -292,12 +342,30 @@ class VisionTransformer(nn.Module):
             # cin = cout
             for i in range(repeats[stage]):
                 stride = strides[stage] if i == 0 else 1
+                dp_i = sum(repeats[:stage]) + i
+                if getattr(block_op, 'takes_drop_mask', False):
+                    drop_path_idx[len(blocks)] = dp_i
                 blocks.append(block_op(cin, cout, stride=1, mlp_ratio=expansion[stage],
-                                       drop_path=dpr.pop(), seq_l=seq_l, head_dim=head_dim,
+                                       drop_path=dpr[dp_i], seq_l=seq_l, head_dim=head_dim,
                                        init_values=init_values))
                 cin = cout
         self.blocks = nn.Sequential(*blocks)
 
+        # per-block plan, so forward_features needs no type or dict dispatch:
+        # (rank to convert x to before the block, 0 if the layout already matches;
+        #  drop-mask row of the block, -1 if it does not take a drop_mask and keeps its own DropPath).
+        # The stem emits (B, C, H, W); layouts only change where the expected rank flips.
+        # Block classes without expected_rank are passed x as-is, with no conversion.
+        self.block_plan = []
+        rank = 4
+        for i, blk in enumerate(self.blocks):
+            expected_rank = getattr(blk, 'expected_rank', rank)
+            convert = expected_rank if expected_rank != rank else 0
+            rank = expected_rank
+            self.block_plan.append((convert, drop_path_idx.get(i, -1)))
+        self.final_rank = rank
+        self.final_h = h
+
         head_dim = final_head_dim
         self.head = nn.Sequential(
             nn.Conv2d(cout, head_dim, kernel_size=(1, 1), stride=(1, 1), padding=(0, 0), bias=False),
@@ -305,7 +373,6 @@ class VisionTransformer(nn.Module):
             nn.GELU(),
         )
         self.final_drop = nn.Dropout(final_drop) if final_drop > 0.0 else nn.Identity()
-        self.avgpool = nn.AdaptiveAvgPool2d(1)
         self.classifier = nn.Linear(head_dim, num_classes)
 
         head_bias = -math.log(self.num_classes) if 'nlhb' in weight_init else 0.
@@ -317,7 +384,10 @@ class VisionTransformer(nn.Module):
                 _init_vit_weights(m, n, head_bias=head_bias, jax_impl=True)
         else:
             # trunc_normal_(self.cls_token, std=.02)
-            self.apply(_init_vit_weights)
+            _init_vit_weights_batched(self)
+
+        # depthwise / pointwise convs get faster kernels on NHWC
+        self.to(memory_format=torch.channels_last)
 
     def _init_weights(self, m):
         # this fn left here for compat with downstream users
@@ -327,21 +397,57 @@ class VisionTransformer(nn.Module):
     def no_weight_decay(self):
         return {'pos_embed', 'dist_token'}
 
+    @torch.no_grad()
+    def fuse_bn(self, approximate_gelu=False):
+        # inference only: fold every Conv2d -> BatchNorm2d pair (stem, DWConvBlock.b1/b2,
+        # LocalDSM.downsample, LocalGlobalDSM.q, head) into the conv and drop the BN,
+        # then script the stem and head so their conv -> gelu runs through the fuser.
+        # approximate_gelu swaps in the tanh GELU there (torch>=1.12), which is not bit-exact.
+        assert not self.training, 'call fuse_bn() after model.eval()'
+        for m in self.modules():
+            if not isinstance(m, nn.Sequential):
+                continue
+            for i in range(1, len(m)):
+                if isinstance(m[i - 1], nn.Conv2d) and isinstance(m[i], nn.BatchNorm2d):
+                    fuse_conv_bn(m[i - 1], m[i])
+                    m[i] = nn.Identity()
+        for name in ('stem', 'head'):
+            seq = getattr(self, name)
+            if approximate_gelu:
+                for i, m in enumerate(seq):
+                    if isinstance(m, nn.GELU):
+                        seq[i] = nn.GELU(approximate='tanh')
+            setattr(self, name, torch.jit.script(seq))
+        return self
+
+    def _sample_drop_masks(self, batch_size):
+        # one bernoulli draw for every (sample, block) pair instead of one DropPath kernel per block;
+        # row j holds the scaled keep mask of the j-th drop-path block
+        keep_prob = 1 - self.dp_probs
+        keep = torch.bernoulli(keep_prob.expand(batch_size, -1))
+        return (keep / keep_prob).t()
+
     def forward_features(self, x):
 
-        x = self.stem(x)
-        for i, blk in enumerate(self.blocks):
-            if isinstance(blk, DWConvBlock):
-                x = to4d(x)
-            if isinstance(blk, AttentionBlock):
+        x = self.stem(x).contiguous(memory_format=torch.channels_last)
+        drop_masks = None
+        if self.training and self.drop_path_rate > 0.:
+            drop_masks = self._sample_drop_masks(x.shape[0])
+        for i, (blk, (convert, dp_i)) in enumerate(zip(self.blocks, self.block_plan)):
+            if convert == 4:
+                x = to4d(x, getattr(blk, 'h', -1))
+            elif convert == 3:
                 x = to3d(x)
+            if drop_masks is not None and dp_i >= 0:
+                blk = partial(blk, drop_mask=drop_masks[dp_i])
             if i < self.checkpoint and x.requires_grad:
                 x = checkpoint.checkpoint(blk, x)
             else:
                 x = blk(x)
-        x = to4d(x)
+        if self.final_rank == 3:
+            x = to4d(x, self.final_h)
         x = self.head(x)
-        x = self.avgpool(x)
+        x = x.mean(dim=(2, 3), keepdim=True)
         return torch.flatten(x, 1)
 
     def forward(self, x):
@@ -351,6 +457,25 @@ class VisionTransformer(nn.Module):
         return x
 
 
+@torch.no_grad()
+def _init_vit_weights_batched(model):
+    # same policy as model.apply(_init_vit_weights), but bucketed in one pass over the modules;
+    # linears are visited in the same order, so the RNG stream is unchanged
+    linears, norms = [], []
+    for m in model.modules():
+        if isinstance(m, nn.Linear):
+            linears.append(m)
+        elif isinstance(m, nn.LayerNorm) and m.elementwise_affine:
+            norms.append(m)
+    for m in linears:
+        trunc_normal_(m.weight, std=.02)
+    biases = [m.bias for m in linears if m.bias is not None] + [m.bias for m in norms]
+    if biases:
+        torch._foreach_zero_(biases)
+    for m in norms:
+        nn.init.ones_(m.weight)
+
+
 def _init_vit_weights(m, n: str = '', head_bias: float = 0., jax_impl: bool = False):
     if isinstance(m, nn.Linear):
         if n.startswith('head'):
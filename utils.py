@@ -327,3 +327,10 @@ def init_distributed_slurm(args):
     torch.distributed.barrier()
     setup_for_distributed(args.rank == 0)
 
+
+def sdpa_flop_jit(inputs, outputs):
+    # fvcore op handle for aten::scaled_dot_product_attention: q @ k^T and attn @ v,
+    # counted as MACs like fvcore's matmul handle (matches Attention.custom_flops)
+    B, H, N, D = inputs[0].type().sizes()
+    M = inputs[1].type().sizes()[-2]
+    return 2 * B * H * N * M * D